@@ -0,0 +1,86 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True, language_level=3
+"""Compiled per-frame squat pipeline used by back_squat_detector when built.
+
+Build in place next to back_squat_detector.py with:
+
+    cythonize -i _squat_core.pyx
+
+Without the compiled module back_squat_detector falls back to its NumPy/Numba path.
+"""
+
+from libc.math cimport atan2, fabs
+
+cdef double _RAD2DEG = 57.29577951308232
+# Angle for coincident points, same as _DEGENERATE_ANGLE in back_squat_detector
+cdef double _DEGENERATE_ANGLE = 90.0
+
+# Same codes as back_squat_detector
+cdef signed char PHASE_STANDING = 0
+cdef signed char PHASE_HALF = 1
+cdef signed char PHASE_DEEP = 2
+
+
+cpdef void step(const float[:, :] hips, const float[:, :] knees, const float[:, :] ankles,
+                const unsigned char[::1] valid, const long long[::1] slots,
+                const unsigned char[::1] thresholds,
+                const signed char[:, ::1] next_state, const signed char[:, ::1] counter_increment,
+                signed char[::1] states, signed char[::1] previous_states, int[::1] counters,
+                signed char[::1] last_phases,
+                signed char[::1] frame_states, int[::1] frame_counters) noexcept nogil:
+    """Compute knee angles and advance the squat state machine for one frame.
+
+    Args:
+        hips, knees, ankles: (N, 2) left hip/knee/ankle coordinates per prediction
+        valid: 1 for predictions that have all required keypoints
+        slots: Index into the state arrays for each prediction
+        thresholds: PHASE_THRESHOLDS from back_squat_detector (deep/half, half/standing)
+        next_state: NEXT_STATE table from back_squat_detector
+        counter_increment: COUNTER_INCREMENT table from back_squat_detector
+        states: Current state code per tracked prediction
+        previous_states: Previous state code per tracked prediction
+        counters: Completed squat count per tracked prediction
+        last_phases: Last known phase code per tracked prediction
+        frame_states: Output, state code of each prediction after its update
+        frame_counters: Output, counter of each prediction after its update
+    """
+    cdef Py_ssize_t i, slot
+    cdef double bax, bay, bcx, bcy, cross, dot, angle
+    cdef signed char phase, previous_state
+
+    for i in range(hips.shape[0]):
+        slot = slots[i]
+        previous_state = states[slot]
+        frame_states[i] = previous_state
+        frame_counters[i] = counters[slot]
+        if not valid[i]:
+            continue
+
+        bax = hips[i, 0] - knees[i, 0]
+        bay = hips[i, 1] - knees[i, 1]
+        bcx = ankles[i, 0] - knees[i, 0]
+        bcy = ankles[i, 1] - knees[i, 1]
+        cross = bax * bcy - bay * bcx
+        dot = bax * bcx + bay * bcy
+        if cross == 0 and dot == 0:
+            # Zero-length limb vector, same rule as calculate_angle
+            angle = _DEGENERATE_ANGLE
+        else:
+            angle = atan2(fabs(cross), dot) * _RAD2DEG
+
+        if angle > thresholds[1]:
+            phase = PHASE_STANDING
+        elif angle > thresholds[0]:
+            phase = PHASE_HALF
+        else:
+            phase = PHASE_DEEP
+
+        previous_states[slot] = previous_state
+        if phase == last_phases[slot]:
+            # Same phase as last time, the state is already settled
+            continue
+        last_phases[slot] = phase
+
+        states[slot] = next_state[previous_state, phase]
+        counters[slot] += counter_increment[previous_state, phase]
+        frame_states[i] = states[slot]
+        frame_counters[i] = counters[slot]
@@ -1,8 +1,186 @@
+import math
+import threading
+from collections import OrderedDict
+from itertools import islice, zip_longest
+
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:
+    # Numba is optional; without it the kernels below run as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+try:
+    # Compiled per-frame pipeline, see _squat_core.pyx; optional like Numba
+    from _squat_core import step as _compiled_step
+except ImportError:
+    _compiled_step = None
+
+
+# Radians to degrees factor, avoids a degrees() call per angle
+_RAD2DEG = 57.29577951308232
+
+# Angle reported when hip or ankle coincides with the knee
+_DEGENERATE_ANGLE = 90.0
+
+# Integer codes for the squat states, used by the per-frame kernel
+STATE_START = 0
+STATE_STANDING = 1
+STATE_DESCENDING = 2
+STATE_SQUATTING = 3
+STATE_ASCENDING = 4
+STATE_NAMES = ("START", "STANDING", "DESCENDING", "SQUATTING", "ASCENDING")
+
+# Label shown for each state code, and the same labels keyed by state name
+STATE_ARROWS = ("Start", "Up", "Dsc", "Down", "Asc")
+_ARROW_MAP = dict(zip(STATE_NAMES, STATE_ARROWS))
+_LABEL_PREFIX = tuple(f"{arrow}: Reps " for arrow in STATE_ARROWS)
+_PREFIX_ARR = np.array(_LABEL_PREFIX)
+
+# Integer codes for the squat phases, also the columns of the tables below
+PHASE_STANDING = 0
+PHASE_HALF = 1
+PHASE_DEEP = 2
+PHASE_UNKNOWN = 3
+PHASE_NAMES = ("standing", "half_squat", "deep_squat", "unknown")
+
+# Knee angle thresholds in whole degrees, and the phase of each np.digitize bin
+PHASE_THRESHOLDS = np.array([73, 170], dtype=np.uint8)
+_BIN_PHASES = np.array([PHASE_DEEP, PHASE_HALF, PHASE_STANDING], dtype=np.int8)
+
+# Next state indexed by [state, phase]
+NEXT_STATE = np.array([
+    # phase: standing  half  deep  unknown
+    [1, 0, 0, 0],  # START
+    [1, 2, 1, 1],  # STANDING
+    [2, 2, 3, 2],  # DESCENDING
+    [3, 4, 3, 3],  # SQUATTING
+    [1, 4, 4, 4],  # ASCENDING
+], dtype=np.int8)
+
+# Counter increment indexed by [state, phase]: a rep ends at ASCENDING -> STANDING
+COUNTER_INCREMENT = np.zeros((5, 4), dtype=np.int8)
+COUNTER_INCREMENT[STATE_ASCENDING, PHASE_STANDING] = 1
+
+# Keypoints needed for the left knee angle, and their indices per keypoint layout
+_REQUIRED = ("left_hip", "left_knee", "left_ankle")
+_kp_index_cache = {}  # {tuple of keypoint names: (hip, knee, ankle) indices or None}
+
+_INITIAL_CAPACITY = 64
+_DEFAULT_MAX_TRACKED = 4096
+
+
+class _SquatStateStore:
+    """Per-prediction squat state stored as parallel arrays (keyed by detection_id or index).
+    
+    Updates must hold `lock` so frames processed from several threads do not
+    interleave slot allocation and state writes. At most `max_tracked`
+    predictions are kept; the least recently seen one is forgotten first.
+    """
+    
+    __slots__ = ("id_to_idx", "states", "prev_states", "counters", "last_phases", "size",
+                 "free_slots", "max_tracked", "lock")
+    
+    def __init__(self, capacity=_INITIAL_CAPACITY, max_tracked=_DEFAULT_MAX_TRACKED):
+        # {prediction_id: slot in the arrays below}, least recently seen first
+        self.id_to_idx = OrderedDict()
+        self.states = np.zeros(capacity, dtype=np.int8)
+        self.prev_states = np.zeros(capacity, dtype=np.int8)
+        self.counters = np.zeros(capacity, dtype=np.int32)
+        # Last known phase; PHASE_UNKNOWN until the first known phase is seen
+        self.last_phases = np.full(capacity, PHASE_UNKNOWN, dtype=np.int8)
+        self.size = 0
+        self.free_slots = []  # Slots below size released by evict
+        self.max_tracked = max_tracked
+        self.lock = threading.RLock()
+    
+    def alloc(self, prediction_id):
+        """Assign a fresh START slot to a prediction, growing the arrays if full.
+        
+        Reuses a slot released by evict when there is one. Never evicts by
+        itself, so slots handed out for the current frame stay valid; callers
+        evict once the whole frame has its slots.
+        
+        Args:
+            prediction_id: Unique identifier for the prediction
+            
+        Returns:
+            Index of the new slot
+        """
+        if self.free_slots:
+            idx = self.free_slots.pop()
+        else:
+            idx = self.size
+            self.size = idx + 1
+        
+        if idx == len(self.states):
+            capacity = 2 * len(self.states)
+            self.states = np.resize(self.states, capacity)
+            self.prev_states = np.resize(self.prev_states, capacity)
+            self.counters = np.resize(self.counters, capacity)
+            self.last_phases = np.resize(self.last_phases, capacity)
+        
+        self.states[idx] = STATE_START
+        self.prev_states[idx] = STATE_START
+        self.counters[idx] = 0
+        self.last_phases[idx] = PHASE_UNKNOWN
+        self.id_to_idx[prediction_id] = idx
+        return idx
+    
+    def evict(self, max_tracked):
+        """Forget the least recently seen predictions until at most max_tracked remain."""
+        while len(self.id_to_idx) > max_tracked:
+            _, idx = self.id_to_idx.popitem(last=False)
+            self.free_slots.append(idx)
+    
+    def slot(self, prediction_id):
+        """Get the slot of a prediction, allocating one on first sight."""
+        idx = self.id_to_idx.get(prediction_id)
+        if idx is None:
+            idx = self.alloc(prediction_id)
+        else:
+            self.id_to_idx.move_to_end(prediction_id)
+        return idx
+    
+    def reset(self, prediction_id=None):
+        """Reset one prediction to START, or forget all predictions if None."""
+        if prediction_id is None:
+            # Slots are reinitialized by alloc, so the arrays can be reused as is
+            self.id_to_idx.clear()
+            self.free_slots.clear()
+            self.size = 0
+        elif prediction_id in self.id_to_idx:
+            idx = self.id_to_idx[prediction_id]
+            self.states[idx] = STATE_START
+            self.prev_states[idx] = STATE_START
+            self.counters[idx] = 0
+            self.last_phases[idx] = PHASE_UNKNOWN
+
+
+_squat_states = _SquatStateStore()
 
-# Dictionary to track state for each prediction (keyed by detection_id or index)
-_prediction_states = {}  # {prediction_id: {"state": "...", "counter": 0}}
+
+def _keypoint_indices(kp_names):
+    """Get the indices of the required keypoints within a keypoint name list.
+    
+    Args:
+        kp_names: Keypoint names of one prediction
+        
+    Returns:
+        Tuple of (hip, knee, ankle) indices, or None if any of them is missing
+    """
+    key = tuple(kp_names)
+    if key not in _kp_index_cache:
+        try:
+            _kp_index_cache[key] = tuple(key.index(name) for name in _REQUIRED)
+        except ValueError:
+            _kp_index_cache[key] = None
+    return _kp_index_cache[key]
 
 
 def calculate_angle(a, b, c):
@@ -16,16 +194,19 @@ def calculate_angle(a, b, c):
     Returns:
         Angle in degrees
     """
-    a = np.array(a)
-    b = np.array(b)
-    c = np.array(c)
-    ba = a - b
-    bc = c - b
-    # Compute cosine similarity, clip to account for floating point errors
-    cosine_angle = np.dot(ba, bc) / (np.linalg.norm(ba) * np.linalg.norm(bc) + 1e-7)
-    cosine_angle = np.clip(cosine_angle, -1.0, 1.0)
-    angle = np.arccos(cosine_angle)
-    return np.degrees(angle)
+    ax, ay = a
+    bx, by = b
+    cx, cy = c
+    bax, bay = ax - bx, ay - by
+    bcx, bcy = cx - bx, cy - by
+    # atan2 of |cross| and dot is numerically safe, so no clipping is needed
+    cross = bax * bcy - bay * bcx
+    dot = bax * bcx + bay * bcy
+    if cross == 0 and dot == 0:
+        # A zero-length vector (coincident points) has no direction; report 90
+        # degrees like the cosine formula with its 1e-7 guard does
+        return _DEGENERATE_ANGLE
+    return math.atan2(abs(cross), dot) * _RAD2DEG
 
 
 def get_squat_phase(left_knee_angle):
@@ -35,21 +216,33 @@ def get_squat_phase(left_knee_angle):
         left_knee_angle: Angle in degrees (None if not available)
         
     Returns:
-        Phase name: "standing", "half_squat", or "deep_squat"
+        Phase code: PHASE_STANDING, PHASE_HALF or PHASE_DEEP (PHASE_UNKNOWN if no angle)
     """
     if left_knee_angle is None:
-        return "unknown"
+        return PHASE_UNKNOWN
     
     # Thresholds for squat phases (adjustable)
     # Standing/upright: angle > 170 degrees
     # Half squat: 73 < angle <= 170 degrees
     # Deep squat: angle <= 73 degrees
     if left_knee_angle > 170:
-        return "standing"
+        return PHASE_STANDING
     elif left_knee_angle > 73:
-        return "half_squat"
+        return PHASE_HALF
     else:
-        return "deep_squat"
+        return PHASE_DEEP
+
+
+def phase_name(phase):
+    """Get the name of a phase code.
+    
+    Args:
+        phase: Phase code from get_squat_phase
+        
+    Returns:
+        Phase name: "standing", "half_squat", "deep_squat" or "unknown"
+    """
+    return PHASE_NAMES[phase]
 
 
 def update_squat_state(prediction_id, phase):
@@ -64,57 +257,90 @@ def update_squat_state(prediction_id, phase):
     
     Args:
         prediction_id: Unique identifier for the prediction
-        phase: Current phase from get_squat_phase
+        phase: Current phase code from get_squat_phase
         
     Returns:
         Tuple of (previous_state, current_state, counter)
     """
-    global _prediction_states
-    
-    # Initialize state for this prediction if not exists
-    if prediction_id not in _prediction_states:
-        _prediction_states[prediction_id] = {
-            "state": "START",
-            "previous_state": "START",
-            "counter": 0
-        }
-    
-    state_info = _prediction_states[prediction_id]
-    previous_state = state_info["state"]  # Current state becomes previous
-    current_state = state_info["state"]
-    counter = state_info["counter"]
-    
-    if phase == "unknown":
-        return (previous_state, current_state, counter)
-    
-    # State machine transitions
-    if current_state == "START":
-        if phase == "standing":
-            current_state = "STANDING"
-    
-    elif current_state == "STANDING":
-        if phase == "half_squat":
-            current_state = "DESCENDING"
-    
-    elif current_state == "DESCENDING":
-        if phase == "deep_squat":
-            current_state = "SQUATTING"
-    
-    elif current_state == "SQUATTING":
-        if phase == "half_squat":
-            current_state = "ASCENDING"
+    previous_state, current_state, counter = _update_state_codes(prediction_id, phase)
+    return (STATE_NAMES[previous_state], STATE_NAMES[current_state], counter)
+
+
+def _update_state_codes(prediction_id, phase):
+    """Same as update_squat_state, but returns integer state codes."""
+    store = _squat_states
+    with store.lock:
+        idx = store.slot(prediction_id)
+        # This prediction is now the most recently seen, so it is never evicted here
+        store.evict(store.max_tracked)
+        previous_state = int(store.states[idx])  # Current state becomes previous
+        current_state = previous_state
+        counter = int(store.counters[idx])
+        
+        if phase == PHASE_UNKNOWN:
+            return (previous_state, current_state, counter)
+        
+        # The transition tables are idempotent, so repeating the last phase
+        # cannot change the state or the counter
+        if phase == store.last_phases[idx]:
+            store.prev_states[idx] = current_state
+            return (previous_state, current_state, counter)
+        store.last_phases[idx] = phase
+        
+        # State machine transitions
+        current_state = int(NEXT_STATE[previous_state, phase])
+        counter += int(COUNTER_INCREMENT[previous_state, phase])
+        
+        # Update stored state
+        store.prev_states[idx] = previous_state
+        store.states[idx] = current_state
+        store.counters[idx] = counter
     
-    elif current_state == "ASCENDING":
-        if phase == "standing":
-            current_state = "STANDING"
-            counter += 1
+    return (previous_state, current_state, counter)
+
+
+@njit
+def _step(phases, slots, states, previous_states, counters, last_phases,
+          frame_states, frame_counters):
+    """Advance the squat state machine for every prediction of a frame.
     
-    # Update stored state
-    state_info["previous_state"] = previous_state
-    state_info["state"] = current_state
-    state_info["counter"] = counter
+    Same transitions as update_squat_state, operating in place on integer
+    state codes.
     
-    return (previous_state, current_state, counter)
+    Args:
+        phases: Phase code per prediction
+        slots: Index into states/previous_states/counters for each prediction
+        states: Current state code per tracked prediction
+        previous_states: Previous state code per tracked prediction
+        counters: Completed squat count per tracked prediction
+        last_phases: Last known phase code per tracked prediction
+        frame_states: Output, state code of each prediction after its update
+        frame_counters: Output, counter of each prediction after its update
+    """
+    for i in range(phases.shape[0]):
+        phase = phases[i]
+        slot = slots[i]
+        if phase == PHASE_UNKNOWN:
+            frame_states[i] = states[slot]
+            frame_counters[i] = counters[slot]
+            continue
+        
+        previous_state = states[slot]
+        if phase == last_phases[slot]:
+            # Same phase as last time, the state is already settled
+            previous_states[slot] = previous_state
+            frame_states[i] = previous_state
+            frame_counters[i] = counters[slot]
+            continue
+        last_phases[slot] = phase
+        
+        current_state = NEXT_STATE[previous_state, phase]
+        counters[slot] += COUNTER_INCREMENT[previous_state, phase]
+        
+        previous_states[slot] = previous_state
+        states[slot] = current_state
+        frame_states[i] = current_state
+        frame_counters[i] = counters[slot]
 
 
 def get_prediction_state(prediction_id):
@@ -126,7 +352,16 @@ def get_prediction_state(prediction_id):
     Returns:
         Dictionary with "state" and "counter", or None if not found
     """
-    return _prediction_states.get(prediction_id)
+    store = _squat_states
+    with store.lock:
+        idx = store.id_to_idx.get(prediction_id)
+        if idx is None:
+            return None
+        return {
+            "state": STATE_NAMES[store.states[idx]],
+            "previous_state": STATE_NAMES[store.prev_states[idx]],
+            "counter": int(store.counters[idx])
+        }
 
 
 def reset_prediction_state(prediction_id=None):
@@ -135,15 +370,25 @@ def reset_prediction_state(prediction_id=None):
     Args:
         prediction_id: Unique identifier for the prediction, or None to reset all
     """
-    global _prediction_states
-    if prediction_id is None:
-        _prediction_states = {}
-    elif prediction_id in _prediction_states:
-        _prediction_states[prediction_id] = {
-            "state": "START",
-            "previous_state": "START",
-            "counter": 0
-        }
+    with _squat_states.lock:
+        _squat_states.reset(prediction_id)
+
+
+def set_max_tracked(max_tracked):
+    """Set how many predictions keep their squat state.
+    
+    Once the limit is exceeded, the least recently seen predictions are
+    forgotten. Predictions of the current frame are always kept, even when a
+    frame has more people than the limit.
+    
+    Args:
+        max_tracked: Maximum number of tracked predictions (at least 1)
+    """
+    if max_tracked < 1:
+        raise ValueError("max_tracked must be at least 1")
+    with _squat_states.lock:
+        _squat_states.max_tracked = max_tracked
+        _squat_states.evict(max_tracked)
 
 
 def get_state_label(state: str) -> str:
@@ -155,14 +400,7 @@ def get_state_label(state: str) -> str:
     Returns:
         Arrow symbol representing the state
     """
-    arrow_map = {
-        "START": "Start",
-        "STANDING": "Up",
-        "DESCENDING": "Dsc",
-        "SQUATTING": "Down",
-        "ASCENDING": "Asc"
-    }
-    return arrow_map.get(state, "Start")
+    return _ARROW_MAP.get(state, "Start")
 
 
 def modify_class_name(class_name: str, left_knee_angle: float = None, prediction_id: str = None) -> str:
@@ -177,9 +415,152 @@ def modify_class_name(class_name: str, left_knee_angle: float = None, prediction
         The modified label with arrow, state, and rep count (no class name)
     """
     phase = get_squat_phase(left_knee_angle)
-    previous_state, current_state, counter = update_squat_state(prediction_id, phase)
-    arrow = get_state_label(current_state)
-    return f"{arrow}: Reps {counter}"
+    previous_state, current_state, counter = _update_state_codes(prediction_id, phase)
+    return _LABEL_PREFIX[current_state] + str(counter)
+
+
+def _stacked_layout(keypoints_class_name, num_predictions):
+    """Get the required keypoint indices if all predictions share one layout.
+    
+    Args:
+        keypoints_class_name: Keypoint names per prediction
+        num_predictions: Number of predictions in the frame
+        
+    Returns:
+        Tuple of (hip, knee, ankle) indices, or None if layouts differ or are incomplete
+    """
+    if len(keypoints_class_name) < num_predictions:
+        return None
+    try:
+        names = np.asarray(keypoints_class_name[:num_predictions])
+    except ValueError:
+        # Ragged keypoint lists cannot be stacked
+        return None
+    if names.ndim != 2 or not (names == names[0]).all():
+        return None
+    return _keypoint_indices(names[0])
+
+
+def _gather_keypoints(keypoints_xy, keypoints_class_name, num_predictions):
+    """Collect the left hip, knee and ankle of every prediction into arrays.
+    
+    Args:
+        keypoints_xy: Keypoint coordinates per prediction
+        keypoints_class_name: Keypoint names per prediction
+        num_predictions: Number of predictions in the frame
+        
+    Returns:
+        Tuple of (hips, knees, ankles, valid): three (N, 2) float32 arrays and a
+        boolean mask of the predictions that have all required keypoints
+    """
+    # Fast path: one (N, K, 2) array with a shared layout is sliced directly
+    kp_idx = None
+    if len(keypoints_xy) >= num_predictions:
+        kp_idx = _stacked_layout(keypoints_class_name, num_predictions)
+    if kp_idx is not None:
+        try:
+            kps = np.asarray(keypoints_xy[:num_predictions], dtype=np.float32)
+        except ValueError:
+            kps = None
+        if kps is not None and kps.ndim == 3:
+            hip_i, knee_i, ankle_i = kp_idx
+            valid = np.ones(num_predictions, dtype=bool)
+            return kps[:, hip_i], kps[:, knee_i], kps[:, ankle_i], valid
+    
+    hips = np.zeros((num_predictions, 2), dtype=np.float32)
+    knees = np.zeros((num_predictions, 2), dtype=np.float32)
+    ankles = np.zeros((num_predictions, 2), dtype=np.float32)
+    valid = np.zeros(num_predictions, dtype=bool)
+    
+    rows = islice(zip(keypoints_xy, keypoints_class_name), num_predictions)
+    for i, (kp_xy, kp_names) in enumerate(rows):
+        kp_idx = _keypoint_indices(kp_names)
+        
+        # Keep the row only if all required keypoints are present
+        if kp_idx is not None:
+            hip_i, knee_i, ankle_i = kp_idx
+            hips[i] = kp_xy[hip_i]
+            knees[i] = kp_xy[knee_i]
+            ankles[i] = kp_xy[ankle_i]
+            valid[i] = True
+    
+    return hips, knees, ankles, valid
+
+
+def _prediction_ids(predictions, num_predictions):
+    """Get the ID of each prediction (detection_id if available, otherwise index).
+    
+    Args:
+        predictions: Prediction dicts of the frame
+        num_predictions: Number of predictions in the frame
+        
+    Returns:
+        List of num_predictions prediction IDs
+    """
+    # Predictions past the end of the list come back as None from zip_longest
+    raw_ids = (
+        prediction.get('detection_id') if isinstance(prediction, dict) else None
+        for prediction in islice(predictions, num_predictions)
+    )
+    return [
+        f"prediction_{i}" if raw_id is None else raw_id
+        for i, raw_id in zip_longest(range(num_predictions), raw_ids)
+    ]
+
+
+def _run_without_keypoints(keypoint_predictions, prediction_ids):
+    """Version of run() for a frame without keypoints.
+    
+    No state can change, so the frame is returned unchanged unless one of its
+    predictions has completed reps; then the stored labels are shown so the
+    rep count does not disappear. Untracked predictions are not allocated.
+    """
+    store = _squat_states
+    with store.lock:
+        slots = [store.id_to_idx.get(pred_id) for pred_id in prediction_ids]
+        tracked = [slot for slot in slots if slot is not None]
+        if not tracked or not store.counters[tracked].any():
+            return {"squat_predictions": keypoint_predictions}
+        
+        frame_states = np.array(
+            [STATE_START if slot is None else store.states[slot] for slot in slots], dtype=np.int8
+        )
+        frame_counters = np.array(
+            [0 if slot is None else store.counters[slot] for slot in slots], dtype=np.int32
+        )
+    
+    keypoint_predictions.data['class_name'] = np.char.add(
+        _PREFIX_ARR[frame_states], frame_counters.astype(np.str_)
+    )
+    return {"squat_predictions": keypoint_predictions}
+
+
+def _run_single(keypoint_predictions, prediction, keypoints_xy, keypoints_class_name):
+    """Scalar version of run() for a frame with exactly one prediction.
+    
+    Avoids the array setup of the vectorized path, which only pays off for
+    several predictions per frame. Uses calculate_angle, which gives
+    coincident points the same angle as the vectorized path.
+    """
+    prediction_id = None
+    if isinstance(prediction, dict):
+        prediction_id = prediction.get('detection_id')
+    if prediction_id is None:
+        prediction_id = "prediction_0"
+    
+    left_knee_angle = None
+    if len(keypoints_xy) and len(keypoints_class_name):
+        kp_idx = _keypoint_indices(keypoints_class_name[0])
+        if kp_idx is not None:
+            kp_xy = keypoints_xy[0]
+            hip_i, knee_i, ankle_i = kp_idx
+            left_knee_angle = calculate_angle(kp_xy[hip_i], kp_xy[knee_i], kp_xy[ankle_i])
+    
+    phase = get_squat_phase(left_knee_angle)
+    previous_state, current_state, counter = _update_state_codes(prediction_id, phase)
+    keypoint_predictions.data['class_name'] = np.array([_LABEL_PREFIX[current_state] + str(counter)])
+    
+    return {"squat_predictions": keypoint_predictions}
 
 
 def run(self, keypoint_predictions) -> dict:
@@ -197,77 +578,70 @@ def run(self, keypoint_predictions) -> dict:
     if class_names is None or not isinstance(class_names, np.ndarray):
         return {"squat_predictions": keypoint_predictions}
     
-    # Calculate left knee angle for each prediction
-    left_knee_angles = []
-    prediction_ids = []
     num_predictions = len(class_names)
     
-    if keypoints_xy is not None and keypoints_class_name is not None:
-        for i in range(num_predictions):
-            left_knee_angle = None
-            prediction_id = None
-            
-            # Get prediction ID (use detection_id if available, otherwise use index)
-            if i < len(predictions) and isinstance(predictions[i], dict):
-                prediction_id = predictions[i].get('detection_id', f"prediction_{i}")
-            else:
-                prediction_id = f"prediction_{i}"
-            
-            prediction_ids.append(prediction_id)
-            
-            # Get keypoints for this prediction
-            if i < len(keypoints_xy) and i < len(keypoints_class_name):
-                kp_xy = keypoints_xy[i]
-                kp_names = keypoints_class_name[i]
-                
-                # Convert to dict for easier access
-                keypoints_dict = {}
-                for name, (x, y) in zip(kp_names, kp_xy):
-                    keypoints_dict[name] = [float(x), float(y)]
-                
-                # Calculate left knee angle if all required keypoints are present
-                if all(k in keypoints_dict for k in ["left_hip", "left_knee", "left_ankle"]):
-                    left_knee_angle = calculate_angle(
-                        keypoints_dict["left_hip"],
-                        keypoints_dict["left_knee"],
-                        keypoints_dict["left_ankle"]
-                    )
-            
-            left_knee_angles.append(left_knee_angle)
-    else:
-        # No keypoints available, use None for all and generate IDs
-        left_knee_angles = [None] * num_predictions
-        prediction_ids = [f"prediction_{i}" for i in range(num_predictions)]
-    
-    # Apply modify_class_name to each class name with its corresponding angle and ID
-    modified = []
-    prediction_states = []
-    for class_name, angle, pred_id in zip(class_names, left_knee_angles, prediction_ids):
-        modified_name = modify_class_name(str(class_name), angle, pred_id)
-        modified.append(modified_name)
+    # Without keypoints no state machine can transition, only stored labels are shown
+    if keypoints_xy is None or keypoints_class_name is None:
+        return _run_without_keypoints(
+            keypoint_predictions, _prediction_ids(predictions, num_predictions)
+        )
+    
+    # A single person per frame is the common case, handle it without arrays
+    if num_predictions == 1:
+        return _run_single(keypoint_predictions, next(iter(predictions), None),
+                           keypoints_xy, keypoints_class_name)
+    
+    prediction_ids = _prediction_ids(predictions, num_predictions)
+    
+    # Gather (hip, knee, ankle) triples so all angles are computed in one pass
+    hips, knees, ankles, valid = _gather_keypoints(
+        keypoints_xy, keypoints_class_name, num_predictions
+    )
+    
+    store = _squat_states
+    frame_states = np.zeros(num_predictions, dtype=np.int8)
+    frame_counters = np.zeros(num_predictions, dtype=np.int32)
+    
+    if _compiled_step is None:
+        # Vectorized equivalent of calculate_angle over all predictions
+        ba = hips - knees
+        bc = ankles - knees
+        numerator = np.einsum('ij,ij->i', ba, bc)
+        norms = np.linalg.norm(ba, axis=1) * np.linalg.norm(bc, axis=1)
+        angles = np.arccos(np.clip(numerator / (norms + 1e-7), -1.0, 1.0))
+        angles *= _RAD2DEG
+        # Coincident points get the same angle as in calculate_angle (and
+        # therefore as in the single-person path)
+        angles[norms == 0] = _DEGENERATE_ANGLE
+        
+        # Quantize to whole degrees (0-180); rounding up keeps "angle > threshold"
+        # exact for the integer thresholds
+        np.ceil(angles, out=angles)
+        angles_u8 = np.clip(angles, 0, 180).astype(np.uint8)
         
-        # Get state info for this prediction
-        state_info = get_prediction_state(pred_id)
-        if state_info:
-            prediction_states.append({
-                "prediction_id": pred_id,
-                "previous_state": state_info.get("previous_state", "START"),
-                "current_state": state_info["state"],
-                "counter": state_info["counter"]
-            })
+        # Same thresholds as get_squat_phase, applied to all angles at once
+        phases = _BIN_PHASES[np.digitize(angles_u8, PHASE_THRESHOLDS, right=True)]
+        # Predictions without the required keypoints have an unknown phase
+        phases[~valid] = PHASE_UNKNOWN
+    
+    with store.lock:
+        slots = np.array([store.slot(pred_id) for pred_id in prediction_ids], dtype=np.int64)
+        if _compiled_step is not None:
+            # Angles, phases and transitions in a single compiled pass
+            _compiled_step(hips, knees, ankles, valid.view(np.uint8), slots,
+                           PHASE_THRESHOLDS, NEXT_STATE, COUNTER_INCREMENT,
+                           store.states, store.prev_states, store.counters,
+                           store.last_phases, frame_states, frame_counters)
         else:
-            # Fallback if state not found
-            prediction_states.append({
-                "prediction_id": pred_id,
-                "previous_state": "START",
-                "current_state": "START",
-                "counter": 0
-            })
-    
-    # Convert back to numpy array with proper dtype
-    max_len = max(len(name) for name in modified)
-    new_dtype = np.dtype(f'U{max_len}')
-    modified_array = np.array(modified, dtype=new_dtype)
+            # Advance every prediction of the frame in place on the state arrays
+            _step(phases, slots, store.states, store.prev_states, store.counters,
+                  store.last_phases, frame_states, frame_counters)
+        # Evict only now that the frame is done; its ids are the most recently
+        # seen and at most num_predictions of them, so none of them is dropped
+        store.evict(max(store.max_tracked, num_predictions))
+    
+    # Assemble all labels at once as prefix + counter string arrays
+    modified_array = np.char.add(_PREFIX_ARR[frame_states], frame_counters.astype(np.str_))
     
     keypoint_predictions.data['class_name'] = modified_array
     